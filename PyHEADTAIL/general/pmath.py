@@ -208,7 +208,7 @@ _CPU_numpy_func_dict = {
     'diff': np.diff,
     'floor': np.floor,
     'argsort': np.argsort,
-    'apply_permutation': lambda array, permutation: array[permutation], #auto copy
+    'apply_permutation': lambda array, permutation, out=None: np.take(array, permutation, out=out), #auto copy
     'mean_per_slice': _mean_per_slice_cpu,
     #'cov_per_slice': lambda sliceset, u: _cov_per_slice_cpu(sliceset, u),
     'std_per_slice': _std_per_slice_cpu,
@@ -41,8 +41,6 @@ if has_pycuda:
     streams = [drv.Stream() for i in range(n_streams)]
     stream_pool = cycle(streams)
 
-    stream_emittance = [drv.Stream() for i in range(6)]
-
 
     def dummy_1(gpuarr, stream=None):
         __dummy1(gpuarr, stream=stream)
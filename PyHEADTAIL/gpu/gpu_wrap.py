@@ -8,15 +8,52 @@ All functions assume GPU arrays as arguments!
 
 import numpy as np
 import os
+import hashlib
+import tempfile
 from . import gpu_utils
 import math
 
+# compiled kernels are shared between processes (e.g. MPI ranks) here
+_kernel_cache_dir = os.environ.get(
+    'PYHEADTAIL_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pyheadtail'))
+
+def _cached_source_module(source, options, name):
+    '''
+    Compile source like pycuda.compiler.SourceModule, but store the
+    cubin in _kernel_cache_dir keyed on the source, the options and the
+    device architecture. Later imports load it without invoking nvcc.
+    '''
+    arch = 'sm_%d%d' % drv.Context.get_device().compute_capability()
+    key = hashlib.sha1(
+        (source + ' '.join(options) + arch).encode('utf-8')).hexdigest()
+    path = os.path.join(_kernel_cache_dir, '%s_%s.cubin' % (name, key))
+    if os.path.isfile(path):
+        return drv.module_from_file(path)
+    cubin = pycuda.compiler.compile(source, options=options, arch=arch,
+                                    cache_dir=False)
+    try:
+        if not os.path.isdir(_kernel_cache_dir):
+            os.makedirs(_kernel_cache_dir)
+        # write to a temporary file first, concurrent processes must
+        # never see a partially written cubin
+        fd, tmp_path = tempfile.mkstemp(dir=_kernel_cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(cubin)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass # no writable cache directory, compile again next time
+    return drv.module_from_buffer(cubin)
+
 try:
     import skcuda.misc
+    import skcuda.fft
     import pycuda.gpuarray
     import pycuda.compiler
     import pycuda.driver as drv
     import pycuda.elementwise
+    import pycuda.reduction
+    import pycuda.tools
     import PyHEADTAIL.gpu.thrust_interface
 
     # if pycuda is there, try to compile things. If no context available,
@@ -30,10 +67,17 @@ try:
         where = os.path.dirname(os.path.abspath(__file__)) + '/'
         with open(where + 'stats.cu') as stream:
             source = stream.read()
-        stats_kernels = pycuda.compiler.SourceModule(source) # compile
+        # cap registers to keep enough warps resident to hide the
+        # memory latency, the per-slice kernels set __launch_bounds__
+        stats_kernels = _cached_source_module(
+            source, ['-O3', '--maxrregcount=64', '-lineinfo'], 'stats')
         sorted_mean_per_slice_kernel = stats_kernels.get_function('sorted_mean_per_slice')
-        sorted_std_per_slice_kernel = stats_kernels.get_function('sorted_std_per_slice')
+        sorted_mean_std_per_slice_kernel = stats_kernels.get_function('sorted_mean_std_per_slice')
         sorted_cov_per_slice_kernel = stats_kernels.get_function('sorted_cov_per_slice')
+        sorted_emittance_cov_per_slice_kernel = stats_kernels.get_function('sorted_emittance_cov_per_slice')
+        slice_bounds_from_sorted_kernel = stats_kernels.get_function('slice_bounds_from_sorted')
+        covariance_sums_kernel = stats_kernels.get_function('covariance_sums')
+        covariance_sums_finalize_kernel = stats_kernels.get_function('covariance_sums_finalize')
         has_pycuda = True
     except pycuda._driver.LogicError: #the error pycuda throws if no context initialized
         print ('Warning: GPU is in principle available but no context has been '
@@ -52,8 +96,58 @@ def _empty_like(gpuarray):
         shape=gpuarray.shape, dtype=gpuarray.dtype,
         allocator=gpu_utils.memory_pool.allocate)
 
+# block sizes by kernel, see _launch_config
+_block_sizes = {}
+
+def _launch_config(kernel, n_threads):
+    '''
+    Return (block, grid) to launch kernel with at least n_threads
+    threads in total. The block size maximising the theoretical
+    occupancy for the kernel's register and shared memory usage is
+    determined once per kernel (like cudaOccupancyMaxPotentialBlockSize)
+    and cached. For less threads than that, the block is shrunk to
+    the next multiple of the warp size.
+    Only for kernels without dynamic shared memory.
+    '''
+    if kernel not in _block_sizes:
+        devdata = pycuda.tools.DeviceData()
+        best = (0, devdata.warp_size)
+        for threads in range(devdata.warp_size,
+                             kernel.max_threads_per_block + 1,
+                             devdata.warp_size):
+            try:
+                occupancy = pycuda.tools.OccupancyRecord(
+                    devdata, threads, shared_mem=kernel.shared_size_bytes,
+                    registers=kernel.num_regs).occupancy
+            except ValueError: # resources exceeded for this block size
+                continue
+            best = max(best, (occupancy, threads))
+        _block_sizes[kernel] = (best[1], devdata.warp_size)
+    block_size, warp_size = _block_sizes[kernel]
+    n_threads = max(n_threads, 1)
+    block_size = min(block_size,
+                     (n_threads + warp_size - 1) // warp_size * warp_size)
+    grid_size = (n_threads + block_size - 1) // block_size
+    return (block_size, 1, 1), (grid_size, 1, 1)
+
+def _zeros(shape, dtype=np.float64, stream=None):
+    '''Zero-filled GPUArray allocated from the memory pool. The memset
+    is enqueued on stream instead of synchronously on the default stream
+    like pycuda.gpuarray.zeros does.
+    '''
+    out = pycuda.gpuarray.empty(shape, dtype=dtype,
+                                allocator=gpu_utils.memory_pool.allocate)
+    drv.memset_d8_async(out.gpudata, 0, out.nbytes, stream)
+    return out
+
 
 if has_pycuda:
+    # page-locked staging buffer for the first and last particle index
+    # within the slicing region, see _add_bounds_to_sliceset
+    _pidx_buffer = drv.pagelocked_empty(
+        2, dtype=np.int32, mem_flags=drv.host_alloc_flags.PORTABLE)
+    _pidx_event = drv.Event()
+
     # define all compilation depending functions (e.g. ElementwiseKernel)
     _sub_1dgpuarr = pycuda.elementwise.ElementwiseKernel(
         'double* out, double* a, const double* b',
@@ -79,6 +173,14 @@ if has_pycuda:
             out = _empty_like(gpuarr)
         _mul_with_factor(out, gpuarr, scalar, stream=stream)
 
+    # the 1/n factor is applied while summing, a single reduction
+    _mean_kernel = pycuda.reduction.ReductionKernel(
+        np.float64, neutral='0', reduce_expr='a+b',
+        map_expr='a[i] * inv_n',
+        arguments='const double* a, const double inv_n',
+        name='mean_kernel'
+    )
+
     def _multiply(a, b, out=None, stream=None):
         '''Elementwise multiply of two gpuarray specifying a stream
         Required because gpuarray.__mul__ has no stream argument'''
@@ -116,6 +218,36 @@ if has_pycuda:
             raise TypeError('currently only np.float64 and np.int32 supported.')
         return out
 
+    _arange_cpu_float64 = pycuda.elementwise.ElementwiseKernel(
+        'double* out, const double start, const double step',
+        'out[i] = start + i * step',
+        '_arange_cpu_float64'
+    )
+    _arange_cpu_int32 = pycuda.elementwise.ElementwiseKernel(
+        'int* out, const int start, const int step',
+        'out[i] = start + i * step',
+        '_arange_cpu_int32'
+    )
+    def arange_startstop_cpu(start, step, n_slices_cpu, dtype=np.float64,
+                             stream=None):
+        '''Same as arange_startstop_gpu for start and step given on the
+        host. Unlike pycuda.gpuarray.arange, the result is allocated
+        from the memory pool.
+        '''
+        if dtype is np.float64:
+            out = pycuda.gpuarray.empty(n_slices_cpu, dtype=np.float64,
+                allocator=gpu_utils.memory_pool.allocate)
+            _arange_cpu_float64(out, np.float64(start), np.float64(step),
+                                stream=stream)
+        elif dtype is np.int32:
+            out = pycuda.gpuarray.empty(n_slices_cpu, dtype=np.int32,
+                allocator=gpu_utils.memory_pool.allocate)
+            _arange_cpu_int32(out, np.int32(start), np.int32(step),
+                              stream=stream)
+        else:
+            raise TypeError('currently only np.float64 and np.int32 supported.')
+        return out
+
     def arange(start, stop, step=1, n_slices=None, dtype=np.float64,
                stream=None):
         """Create an array filled with numbers spaced `step` apart,
@@ -129,6 +261,9 @@ if has_pycuda:
             n_slices = int(np.ceil((stop - start) / step))
         if isinstance(start, pycuda.gpuarray.GPUArray):
             return arange_startstop_gpu(start, stop, step, n_slices, dtype)
+        elif dtype is np.float64 or dtype is np.int32:
+            return arange_startstop_cpu(start, step, n_slices, dtype,
+                                        stream=stream)
         else:
             return pycuda.gpuarray.arange(start, stop, step, dtype=dtype)
 
@@ -155,9 +290,16 @@ if has_pycuda:
                   'double* cov_up2, double* cov_u_dp, double* cov_up_dp, '
                   'double* cov_dp2, double nn',
         #operation='out[i] = nn',
-        operation='double sigma11 = cov_u2[i]   - cov_u_dp[i] *cov_u_dp[i] / cov_dp2[i];'
-                  'double sigma12 = cov_u_up[i] - cov_u_dp[i] *cov_up_dp[i]/ cov_dp2[i];'
-                  'double sigma22 = cov_up2[i]  - cov_up_dp[i]*cov_up_dp[i]/ cov_dp2[i];'
+        # without momentum spread (cov_dp2 == 0) there is no dispersion
+        # correction, same as in the CPU version
+        operation='double sigma11 = cov_u2[i];'
+                  'double sigma12 = cov_u_up[i];'
+                  'double sigma22 = cov_up2[i];'
+                  'if (cov_dp2[i] != 0) {'
+                      'sigma11 -= cov_u_dp[i] *cov_u_dp[i] / cov_dp2[i];'
+                      'sigma12 -= cov_u_dp[i] *cov_up_dp[i]/ cov_dp2[i];'
+                      'sigma22 -= cov_up_dp[i]*cov_up_dp[i]/ cov_dp2[i];'
+                  '}'
                   'out[i] = sqrt((1./(nn*nn+nn))*(sigma11 * sigma22 - sigma12*sigma12))',
         name='_emitt_disp',
     )
@@ -186,6 +328,12 @@ if has_pycuda:
                       stream=stream)
         return out
 
+    _mul_complex = pycuda.elementwise.ElementwiseKernel(
+        'pycuda::complex<double>* a, const pycuda::complex<double>* b',
+        'a[i] = a[i] * b[i]',
+        '_mul_complex'
+    )
+
     _wofz = pycuda.elementwise.ElementwiseKernel(
         arguments='double* in_real, double* in_imag, double* out_real, '
                   'double* out_imag',
@@ -232,9 +380,11 @@ if has_pycuda:
                  atol=np_allclose_defaults[1], out=None, stream=None):
         assert a.shape == b.shape
         if out is None:
-            out = pycuda.gpuarray.empty(a.shape, dtype=np.int32)
+            out = pycuda.gpuarray.empty(a.shape, dtype=np.int32,
+                                        allocator=gpu_utils.memory_pool.allocate)
         _allclose(a, b, out, atol, rtol)
-        how_many_not_close = pycuda.gpuarray.sum(out).get()
+        how_many_not_close = pycuda.gpuarray.sum(
+            out, allocator=gpu_utils.memory_pool.allocate).get()
         return how_many_not_close == 0
 
     # assigns stat_noncontained entries to stat_contained
@@ -273,16 +423,14 @@ if has_pycuda:
             p_sids, u, slice_ids_noncontained, slice_means_noncontained,
             slice_stds_noncontained)
 
-        mean_u = pycuda.gpuarray.zeros(sliceset.n_slices, dtype=np.float64,
-                                       allocator=gpu_utils.memory_pool.allocate)
-        sigma_u = pycuda.gpuarray.zeros(sliceset.n_slices, dtype=np.float64,
-                                        allocator=gpu_utils.memory_pool.allocate)
+        mean_u = _zeros(sliceset.n_slices, dtype=np.float64, stream=stream)
+        sigma_u = _zeros(sliceset.n_slices, dtype=np.float64, stream=stream)
         _reassign_valid(slice_ids_noncontained[:new_end],
                         slice_means_noncontained[:new_end],
-                        sliceset.n_slices, mean_u)
+                        sliceset.n_slices, mean_u, stream=stream)
         _reassign_valid(slice_ids_noncontained[:new_end],
                         slice_stds_noncontained[:new_end],
-                        sliceset.n_slices, sigma_u)
+                        sliceset.n_slices, sigma_u, stream=stream)
         return (mean_u, sigma_u)
 
 
@@ -355,13 +503,39 @@ def covariance_old(a, b):
         b: pycuda.GPUArray
     '''
     n = len(a)
-    mean_a = skcuda.misc.mean(a).get()
+    mean_a = mean(a).get()
     x = a - mean_a
-    mean_b = skcuda.misc.mean(b).get()
+    mean_b = mean(b).get()
     y = b - mean_b
-    covariance = skcuda.misc.mean(x * y) * n / (n + 1)
+    covariance = mean(x * y) * n / (n + 1)
     return covariance.get()
 
+def _centered_sum(a, b, stream=None):
+    '''Return sum((a - mean(a)) * (b - mean(b))) as a GPUArray of
+    length 1. Both arrays are read only once: the covariance_sums kernel
+    accumulates sum(a), sum(b) and sum(a*b) (shifted by the first
+    entries) in a single pass, covariance_sums_finalize combines the
+    block results on the device.
+    '''
+    n = len(a)
+    block = (256, 1, 1)
+    shared = 3 * block[0] * np.dtype(np.float64).itemsize
+    n_blocks = min(max((n + block[0] - 1) // block[0], 1), block[0])
+    partial_sums = pycuda.gpuarray.empty(
+        3 * n_blocks, dtype=np.float64,
+        allocator=gpu_utils.memory_pool.allocate)
+    out = pycuda.gpuarray.empty(1, dtype=np.float64,
+                                allocator=gpu_utils.memory_pool.allocate)
+    covariance_sums_kernel(a.gpudata, b.gpudata, np.int32(n),
+                           partial_sums.gpudata,
+                           block=block, grid=(n_blocks, 1, 1),
+                           shared=shared, stream=stream)
+    covariance_sums_finalize_kernel(partial_sums.gpudata, np.int32(n_blocks),
+                                    np.float64(n), out.gpudata,
+                                    block=block, grid=(1, 1, 1),
+                                    shared=shared, stream=stream)
+    return out
+
 def covariance(a,b, stream=None):
     '''Covariance (not covariance matrix)
     Args:
@@ -369,15 +543,9 @@ def covariance(a,b, stream=None):
         b: pycuda.GPUArray
     '''
     n = len(a)
-    x = _empty_like(a)
-    y = _empty_like(b)
-    mean_a = skcuda.misc.mean(a)
-    #x -= mean_a
-    _sub_1dgpuarr(x, a, mean_a, stream=stream)
-    mean_b = skcuda.misc.mean(b)
-    #y -= mean_b
-    _sub_1dgpuarr(y, b, mean_b, stream=stream)
-    covariance = skcuda.misc.mean(x * y) * (n / (n + 1))
+    covariance = _centered_sum(a, b, stream=stream)
+    _mul_scalar(covariance, np.float64(1. / (n + 1)), out=covariance,
+                stream=stream)
     return covariance
 
 def mean(a, stream=None):
@@ -386,12 +554,9 @@ def mean(a, stream=None):
     the stream (because gpuarray.__div__ does not have a stream
     argument).
     '''
-    #out = pycuda.gpuarray.empty(1, dtype=np.float64, allocator=gpu_utils.memory_pool.allocate)
     n = len(a)
-    out = pycuda.gpuarray.sum(a, stream=stream,
-                              allocator=gpu_utils.memory_pool.allocate)
-    _mul_scalar(out=out, gpuarr=out, scalar=np.float64(1./n), stream=stream)
-    return out
+    return _mean_kernel(a, np.float64(1./n), stream=stream,
+                        allocator=gpu_utils.memory_pool.allocate)
 
 def std(a, stream=None):
     '''Std of a vector'''
@@ -402,7 +567,8 @@ def std(a, stream=None):
     mean_a = mean(a, stream=stream)
     _sub_1dgpuarr(x, a, mean_a, stream=stream)
     _inplace_pow(x, 2, stream=stream)
-    res =  pycuda.gpuarray.sum(x, stream=stream)
+    res =  pycuda.gpuarray.sum(x, stream=stream,
+                               allocator=gpu_utils.memory_pool.allocate)
     _mul_scalar(out=res, gpuarr=res, scalar=np.float64(1./(n-1)), stream=stream)
     _inplace_pow(res, 0.5, stream=stream)
     return res
@@ -418,7 +584,7 @@ def emittance_reference(u, up, dp):
     '''
     cov_u2 = covariance(u, u)
     cov_up2 = covariance(up, up)
-    cov_u_up = covariance(up, u)
+    cov_u_up = covariance(u, up)
 
     term_u2_dp = 0.
     term_u_up_dp = 0.
@@ -454,31 +620,27 @@ def emittance_(u, up, dp):
         dp longitudinal momentum variation
     '''
     n = len(u)
-    mean_u = skcuda.misc.mean(u)
-    mean_up = skcuda.misc.mean(up)
+    mean_u = mean(u)
+    mean_up = mean(up)
     tmp_u = sub_scalar(u, mean_u)
     tmp_up = sub_scalar(up, mean_up)
     cov_u2 = pycuda.gpuarray.sum(tmp_u * tmp_u)
     cov_u_up = pycuda.gpuarray.sum(tmp_u * tmp_up)
     cov_up2 = pycuda.gpuarray.sum(tmp_up * tmp_up)
-
-    sigma11 = cov_u2
-    sigma12 = cov_u_up
-    sigma22 = cov_up2
+    out = _empty_like(cov_u2)
 
     if dp is not None: #if not None, assign values to variables involving dp
-        mean_dp = skcuda.misc.mean(dp)
+        mean_dp = mean(dp)
         tmp_dp = sub_scalar(dp, mean_dp)
         cov_dp2 = pycuda.gpuarray.sum(tmp_dp * tmp_dp)
-
-        if cov_dp2.get() != 0:
-            cov_u_dp = pycuda.gpuarray.sum(tmp_u * tmp_dp)
-            cov_up_dp = pycuda.gpuarray.sum(tmp_up * tmp_dp)
-
-            sigma11 -= cov_u_dp * cov_u_dp / cov_dp2
-            sigma12 -= cov_u_dp * cov_up_dp / cov_dp2
-            sigma22 -= cov_up_dp * cov_up_dp / cov_dp2
-    return pycuda.cumath.sqrt((1./(n*n+n))*(sigma11 * sigma22 - sigma12*sigma12))
+        cov_u_dp = pycuda.gpuarray.sum(tmp_u * tmp_dp)
+        cov_up_dp = pycuda.gpuarray.sum(tmp_up * tmp_dp)
+        # skips the dispersion terms itself if cov_dp2 == 0
+        _emitt_disp(out, cov_u2, cov_u_up, cov_up2,
+                    cov_u_dp, cov_up_dp, cov_dp2, np.float64(n))
+    else:
+        _emitt_nodisp(out, cov_u2, cov_u_up, cov_up2, np.float64(n))
+    return out
 
 
 def emittance(u, up, dp, stream=None):
@@ -493,34 +655,17 @@ def emittance(u, up, dp, stream=None):
         stream: In which cuda stream to perform the computations
     '''
     n = len(u)
-    mean_u = mean(u, stream=stream)
-    mean_up = mean(up, stream=stream)
-    out = _empty_like(mean_u)
-    tmp_u = sub_scalar(u, mean_u, stream=stream)
-    tmp_up = sub_scalar(up, mean_up, stream=stream)
-    tmp_space = _multiply(tmp_u, tmp_u, stream=stream)
-    cov_u2 = pycuda.gpuarray.sum(tmp_space, stream=stream)
-    tmp_space = _multiply(tmp_u, tmp_up, out=tmp_space, stream=stream) #specify out to reuse memory, the stream implicitly serializes everything s.t. nothing bad happens...
-    cov_u_up = pycuda.gpuarray.sum(tmp_space, stream=stream)
-    tmp_space = _multiply(tmp_up, tmp_up, out=tmp_space, stream=stream)
-    cov_up2 = pycuda.gpuarray.sum(tmp_space, stream=stream)
-
-    include_dp = dp is not None
-    if include_dp: #if not None, assign values to variables involving dp
-        mean_dp = mean(dp, stream=stream)
-        tmp_dp = sub_scalar(dp, mean_dp, stream=stream)
-
-        tmp_space = _multiply(tmp_dp, tmp_dp, out=tmp_space, stream=stream)
-        cov_dp2 = pycuda.gpuarray.sum(tmp_space, stream=stream)
+    cov_u2 = _centered_sum(u, u, stream=stream)
+    cov_u_up = _centered_sum(u, up, stream=stream)
+    cov_up2 = _centered_sum(up, up, stream=stream)
+    out = _empty_like(cov_u2)
 
-        if cov_dp2.get() == 0:
-            include_dp = False
-        else:
-            tmp_space = _multiply(tmp_u, tmp_dp, out=tmp_space, stream=stream)
-            cov_u_dp = pycuda.gpuarray.sum(tmp_space, stream=stream)
-            tmp_space = _multiply(tmp_up, tmp_dp, out=tmp_space, stream=stream)
-            cov_up_dp = pycuda.gpuarray.sum(tmp_space, stream=stream)
-    if include_dp:
+    # everything stays on the device: _emitt_disp itself drops the
+    # dispersion terms if cov_dp2 turns out to be 0
+    if dp is not None: #if not None, assign values to variables involving dp
+        cov_dp2 = _centered_sum(dp, dp, stream=stream)
+        cov_u_dp = _centered_sum(u, dp, stream=stream)
+        cov_up_dp = _centered_sum(up, dp, stream=stream)
         #em = _emittance_dispersion(n, cov_u2, cov_u_up, cov_up2, cov_u_dp, cov_up_dp, cov_dp2, out=out, stream=stream)
         _emitt_disp(out, cov_u2, cov_u_up, cov_up2,
                     cov_u_dp, cov_up_dp, cov_dp2, np.float64(n), stream=stream)
@@ -549,26 +694,50 @@ def cumsum(array, dest=None):
     return dest
 
 
+if has_pycuda:
+    # CUB radix sort and its scratch size by (dtype.itemsize, dtype.kind)
+    _sort_dispatch = {
+        (8, 'f'): (thrust.get_sort_perm_double_cub,
+                   thrust.sort_perm_temp_bytes_double),
+        (4, 'i'): (thrust.get_sort_perm_int_cub,
+                   thrust.sort_perm_temp_bytes_int),
+    }
+    # thrust implementations by (dtype.itemsize, dtype.kind)
+    _permute_dispatch = {
+        (8, 'f'): thrust.apply_sort_perm_double,
+        (4, 'i'): thrust.apply_sort_perm_int,
+    }
+
+# CUB scratch buffer reused by all argsort calls, only grows
+_sort_temp = None
+_sort_temp_bytes = 0
+
 def argsort(to_sort):
     '''
-    Return the permutation required to sort the array.
+    Return the permutation required to sort the array (stable sort).
     Args:
         to_sort: gpuarray for which the permutation array to sort
-                 it is returned
+                 it is returned, it is left untouched
     '''
+    global _sort_temp, _sort_temp_bytes
     dtype = to_sort.dtype
+    try:
+        get_sort_perm, sort_temp_bytes = _sort_dispatch[
+            (dtype.itemsize, dtype.kind)]
+    except KeyError:
+        raise TypeError('argsort supports only float64 and int32, '
+                        'got %s' % dtype)
+    n = len(to_sort)
+    temp_bytes = sort_temp_bytes(n)
+    if _sort_temp is None or temp_bytes > _sort_temp_bytes:
+        _sort_temp_bytes = max(temp_bytes, 1)
+        _sort_temp = gpu_utils.memory_pool.allocate(_sort_temp_bytes)
     permutation = pycuda.gpuarray.empty(
         to_sort.shape, dtype=np.int32,
         allocator=gpu_utils.memory_pool.allocate)
-    if dtype.itemsize == 8 and dtype.kind is 'f':
-        thrust.get_sort_perm_double(to_sort.copy(), permutation)
-    elif dtype.itemsize == 4 and dtype.kind is 'i':
-        thrust.get_sort_perm_int(to_sort.copy(), permutation)
-    else:
-        print(to_sort.dtype)
-        print(to_sort.dtype.itemsize)
-        print(to_sort.dtype.kind)
-        raise TypeError('Currently only float64 and int32 types can be sorted')
+    sorted_keys = _empty_like(to_sort)
+    get_sort_perm(to_sort, permutation, _seq(0, n), sorted_keys,
+                  _sort_temp, _sort_temp_bytes)
     return permutation
 
 def searchsortedleft(array, values, dest_array=None):
@@ -587,36 +756,50 @@ def searchsortedright(array, values, dest_array=None):
     thrust.upper_bound_int(array, values, dest_array)
     return dest_array
 
-def apply_permutation(array, permutation):
+def apply_permutation(array, permutation, out=None):
     '''
     Permute the entries in array according to the permutation array.
     Return a new (permuted) array which is equal to array[permutation]
     Args:
         array gpuarray to be permuted. Either float64 or int32
         permutation permutation array: must be np.int32 (or int32), is asserted
+        out optional gpuarray like array to store the result in, it must
+            not share memory with array. By default a new array is taken
+            from the memory pool
     '''
-    assert(permutation.dtype.itemsize == 4 and permutation.dtype.kind is 'i')
-    tmp = _empty_like(array)
+    assert(permutation.dtype.itemsize == 4 and permutation.dtype.kind == 'i')
     dtype = array.dtype
-    if dtype.itemsize == 8 and dtype.kind is 'f':
-        thrust.apply_sort_perm_double(array, tmp, permutation)
-    elif dtype.itemsize == 4 and dtype.kind is 'i':
-        thrust.apply_sort_perm_int(array, tmp, permutation)
-    else:
-        print(array.dtype)
-        print(array.dtype.itemsize)
-        print(array.dtype.kind)
-        raise TypeError('Currently only float64 and int32 types can be sorted')
-    return tmp
+    try:
+        apply_sort_perm = _permute_dispatch[(dtype.itemsize, dtype.kind)]
+    except KeyError:
+        raise TypeError('apply_permutation supports only float64 and int32, '
+                        'got %s' % dtype)
+    if out is None:
+        out = _empty_like(array)
+    apply_sort_perm(array, out, permutation)
+    return out
+
+# ascending np.int32 sequence shared by all index ranges, see _seq
+_seq_int32 = None
+
+def _seq(start, stop):
+    '''
+    Return the index range [start, stop) as an np.int32 GPUArray.
+    The result is a view into a cached sequence which is only
+    reallocated when it needs to grow, it must not be modified in place!
+    '''
+    global _seq_int32
+    if _seq_int32 is None or len(_seq_int32) < stop:
+        _seq_int32 = arange(0, stop, dtype=np.int32)
+    return _seq_int32[start:stop]
 
 def particles_within_cuts(sliceset):
     '''
     Return np.where((array >= minimum) and (array <= maximum))
-    Assumes a sorted beam!
+    Assumes a sorted beam! The returned index array is read-only.
     '''
-    if (not hasattr(sliceset, 'upper_bounds')) and (not hasattr(sliceset, 'lower_bounds')):
-        _add_bounds_to_sliceset(sliceset)
-    idx = arange(sliceset.pidx_begin, sliceset.pidx_end, dtype=np.int32)
+    _ensure_bounds(sliceset)
+    idx = _seq(int(sliceset.pidx_begin), int(sliceset.pidx_end))
     return idx
 
 def particles_outside_cuts(sliceset):
@@ -624,8 +807,7 @@ def particles_outside_cuts(sliceset):
     Return np.where((array < minimum) and (array > maximum))
     Assumes a sorted beam!
     '''
-    if (not hasattr(sliceset, 'upper_bounds')) and (not hasattr(sliceset, 'lower_bounds')):
-        _add_bounds_to_sliceset(sliceset)
+    _ensure_bounds(sliceset)
     n_part_inside = sliceset.pidx_end - sliceset.pidx_begin
     n_part_outside = len(sliceset.slice_index_of_particle) - n_part_inside
     idx = arange(0, n_part_outside, dtype=np.int32)
@@ -637,27 +819,54 @@ def macroparticles_per_slice(sliceset):
     Return the number of macroparticles per slice. Assumes a sorted beam!
     '''
     # simple: upper_bounds - lower_bounds!
-    if (not hasattr(sliceset, 'upper_bounds')) and (not hasattr(sliceset, 'lower_bounds')):
-        _add_bounds_to_sliceset(sliceset)
+    _ensure_bounds(sliceset)
     return sliceset.upper_bounds - sliceset.lower_bounds
 
 
+def _ensure_bounds(sliceset):
+    '''
+    Adds the lower_bounds and upper_bounds members to the sliceset unless
+    they were already computed for its current slice_index_of_particle
+    and n_slices. A re-sliced sliceset thus never uses stale bounds.
+    '''
+    key = getattr(sliceset, '_bounds_key', None)
+    if (key is None or key[0] is not sliceset.slice_index_of_particle
+            or key[1] != sliceset.n_slices):
+        _add_bounds_to_sliceset(sliceset)
+
 def _add_bounds_to_sliceset(sliceset):
     '''
-    Adds the lower_bounds and upper_bounds members to the sliceset
-    They must not present before the function call, otherwise undefined behaviour
+    Adds the lower_bounds and upper_bounds members to the sliceset,
+    overwriting existing ones. Use _ensure_bounds to compute them only once.
     '''
-    seq = pycuda.gpuarray.arange(sliceset.n_slices, dtype=np.int32)# not supported in pycuda:, allocator=gpu_utils.memory_pool.allocate)
-    upper_bounds = pycuda.gpuarray.empty(shape=seq.shape, dtype=np.int32, allocator=gpu_utils.memory_pool.allocate)
-    lower_bounds = pycuda.gpuarray.empty(shape=seq.shape, dtype=np.int32, allocator=gpu_utils.memory_pool.allocate)
-    thrust.upper_bound_int(sliceset.slice_index_of_particle,
-                                            seq, upper_bounds)
-    thrust.lower_bound_int(sliceset.slice_index_of_particle,
-                                            seq, lower_bounds)
+    n_slices = sliceset.n_slices
+    n_particles = len(sliceset.slice_index_of_particle)
+    upper_bounds = pycuda.gpuarray.empty(shape=(n_slices,), dtype=np.int32, allocator=gpu_utils.memory_pool.allocate)
+    lower_bounds = pycuda.gpuarray.empty(shape=(n_slices,), dtype=np.int32, allocator=gpu_utils.memory_pool.allocate)
+    if n_particles == 0:
+        drv.memset_d32(lower_bounds.gpudata, 0, n_slices)
+        drv.memset_d32(upper_bounds.gpudata, 0, n_slices)
+    else:
+        # both bounds in one pass, one thread per transition between particles
+        block, grid = _launch_config(slice_bounds_from_sorted_kernel,
+                                     n_particles + 1)
+        slice_bounds_from_sorted_kernel(
+            sliceset.slice_index_of_particle.gpudata, np.int32(n_particles),
+            np.int32(n_slices), lower_bounds.gpudata, upper_bounds.gpudata,
+            block=block, grid=grid)
     sliceset.upper_bounds = upper_bounds
     sliceset.lower_bounds = lower_bounds
-    sliceset._pidx_begin = lower_bounds[0].get() # set those properties now!
-    sliceset._pidx_end = upper_bounds[-1].get()  # this way .get() gets called only once
+    # set those properties now, this way the transfer happens only once:
+    # both entries go to the pinned buffer, then synchronise a single time
+    itemsize = upper_bounds.dtype.itemsize
+    drv.memcpy_dtoh_async(_pidx_buffer[0:1], lower_bounds.gpudata)
+    drv.memcpy_dtoh_async(_pidx_buffer[1:2],
+                          int(upper_bounds.gpudata) + (n_slices - 1) * itemsize)
+    _pidx_event.record()
+    _pidx_event.synchronize()
+    sliceset._pidx_begin = int(_pidx_buffer[0])
+    sliceset._pidx_end = int(_pidx_buffer[1])
+    sliceset._bounds_key = (sliceset.slice_index_of_particle, n_slices)
 
 def sorted_mean_per_slice(sliceset, u, stream=None):
     '''
@@ -667,11 +876,10 @@ def sorted_mean_per_slice(sliceset, u, stream=None):
         u the array of which to compute the mean
     Return the an array, res[i] stores the mean of slice i
     '''
-    if (not hasattr(sliceset, 'upper_bounds')) and (not hasattr(sliceset, 'lower_bounds')):
-        _add_bounds_to_sliceset(sliceset)
+    _ensure_bounds(sliceset)
 
-    block = (256, 1, 1)
-    grid = (max(sliceset.n_slices // block[0], 1), 1, 1)
+    block, grid = _launch_config(sorted_mean_per_slice_kernel,
+                                 sliceset.n_slices)
     #!!! managed memory, requires comp. capability >=3.0 (not on TeslaC2075)!
     #mean_u = drv.managed_zeros(sliceset.n_slices, dtype=np.float64, mem_flags=drv.mem_attach_flags.GLOBAL)
     mean_u = pycuda.gpuarray.empty(sliceset.n_slices, dtype=np.float64, allocator=gpu_utils.memory_pool.allocate)
@@ -682,6 +890,27 @@ def sorted_mean_per_slice(sliceset, u, stream=None):
                                  block=block, grid=grid, stream=stream)
     return mean_u
 
+def sorted_mean_std_per_slice(sliceset, u, stream=None):
+    '''
+    Computes the mean and the standard deviation per slice of the
+    array u in a single pass over the particles
+    Args:
+        sliceset specifying slices
+        u the array of which to compute the mean and std
+    Return the arrays mean_u and std_u, res[i] stores the value of slice i
+    '''
+    _ensure_bounds(sliceset)
+    block, grid = _launch_config(sorted_mean_std_per_slice_kernel,
+                                 sliceset.n_slices)
+    mean_u = pycuda.gpuarray.empty(sliceset.n_slices, dtype=np.float64, allocator=gpu_utils.memory_pool.allocate)
+    std_u = pycuda.gpuarray.empty(sliceset.n_slices, dtype=np.float64, allocator=gpu_utils.memory_pool.allocate)
+    sorted_mean_std_per_slice_kernel(sliceset.lower_bounds.gpudata,
+                                     sliceset.upper_bounds.gpudata,
+                                     u.gpudata, np.int32(sliceset.n_slices),
+                                     mean_u.gpudata, std_u.gpudata,
+                                     block=block, grid=grid, stream=stream)
+    return mean_u, std_u
+
 def sorted_std_per_slice(sliceset, u, stream=None):
     '''
     Computes the cov per slice of the array u
@@ -690,17 +919,7 @@ def sorted_std_per_slice(sliceset, u, stream=None):
         u the array of which to compute the cov
     Return an array, res[i] stores the cov of slice i
     '''
-    if (not hasattr(sliceset, 'upper_bounds')) and (not hasattr(sliceset, 'lower_bounds')):
-        _add_bounds_to_sliceset(sliceset)
-    block = (256, 1, 1)
-    grid = (max(sliceset.n_slices // block[0], 1), 1, 1)
-    std_u = pycuda.gpuarray.empty(sliceset.n_slices, dtype=np.float64, allocator=gpu_utils.memory_pool.allocate)
-    sorted_std_per_slice_kernel(sliceset.lower_bounds.gpudata,
-                                sliceset.upper_bounds.gpudata,
-                                u.gpudata, np.int32(sliceset.n_slices),
-                                std_u.gpudata,
-                                block=block, grid=grid, stream=stream)
-    return std_u
+    return sorted_mean_std_per_slice(sliceset, u, stream=stream)[1]
 
 def sorted_cov_per_slice(sliceset, u, v, stream=None):
     '''
@@ -709,10 +928,9 @@ def sorted_cov_per_slice(sliceset, u, v, stream=None):
         sliceset specifying slices
         u, v the arrays of which to compute the covariance
     '''
-    if (not hasattr(sliceset, 'upper_bounds')) and (not hasattr(sliceset, 'lower_bounds')):
-        _add_bounds_to_sliceset(sliceset)
-    block = (256, 1, 1)
-    grid = (max(sliceset.n_slices // block[0], 1), 1, 1)
+    _ensure_bounds(sliceset)
+    block, grid = _launch_config(sorted_cov_per_slice_kernel,
+                                 sliceset.n_slices)
     cov_uv = pycuda.gpuarray.empty(sliceset.n_slices, dtype=np.float64, allocator=gpu_utils.memory_pool.allocate)
     sorted_cov_per_slice_kernel(sliceset.lower_bounds.gpudata,
                                 sliceset.upper_bounds.gpudata,
@@ -733,23 +951,21 @@ def sorted_emittance_per_slice_slow(sliceset, u, up, dp=None, stream=None):
     cov_u2 = sorted_cov_per_slice(sliceset, u, u, stream=stream)
     cov_up2 = sorted_cov_per_slice(sliceset, up, up, stream=stream)
     cov_u_up = sorted_cov_per_slice(sliceset, u, up, stream=stream)
-
-    sigma11 = cov_u2
-    sigma12 = cov_u_up
-    sigma22 = cov_up2
+    emittance = _empty_like(cov_u2)
+    # cf. sorted_emittance_per_slice: 1/(n*n + n) == 1 for this n
+    n = np.sqrt(5.)/2. - 0.5
 
     if dp is not None:
         cov_dp2 = sorted_cov_per_slice(sliceset, dp, dp, stream=stream)
+        cov_u_dp = sorted_cov_per_slice(sliceset, u, dp, stream=stream)
+        cov_up_dp= sorted_cov_per_slice(sliceset, up, dp, stream=stream)
 
-        if cov_dp2.get().any():
-            cov_u_dp = sorted_cov_per_slice(sliceset, u, dp, stream=stream)
-            cov_up_dp= sorted_cov_per_slice(sliceset, up, dp, stream=stream)
+        _emitt_disp(emittance, cov_u2, cov_u_up, cov_up2, cov_u_dp,
+                    cov_up_dp, cov_dp2, np.float64(n), stream=stream)
+        return emittance
 
-            sigma11 -= cov_u_dp * cov_u_dp / cov_dp2
-            sigma12 -= cov_u_dp * cov_up_dp / cov_dp2
-            sigma22 -= cov_up_dp * cov_up_dp / cov_dp2
-
-    emittance = pycuda.cumath.sqrt(sigma11*sigma22 - sigma12*sigma12)
+    _emitt_nodisp(emittance, cov_u2, cov_u_up, cov_up2, np.float64(n),
+                  stream=stream)
     return emittance
 
 
@@ -761,31 +977,35 @@ def sorted_emittance_per_slice(sliceset, u, up, dp=None, stream=None):
         sliceset specifying slices
         u, up the quantities of which to compute the emittance, e.g. x,xp
     '''
-    ### computes the covariance on different streams
-    streams = gpu_utils.stream_emittance
-    cov_u2 = sorted_cov_per_slice(sliceset, u, u, stream=streams[0])
-    cov_up2= sorted_cov_per_slice(sliceset, up, up, stream=streams[1])
-    cov_u_up = sorted_cov_per_slice(sliceset, u, up, stream=streams[2])
+    _ensure_bounds(sliceset)
+    ### computes all covariances in a single kernel launch
+    include_dp = dp is not None
+    n_covs = 6 if include_dp else 3
+    covs = [pycuda.gpuarray.empty(sliceset.n_slices, dtype=np.float64,
+                                  allocator=gpu_utils.memory_pool.allocate)
+            for i in range(n_covs)]
+    cov_ptrs = [cov.gpudata for cov in covs]
+    if not include_dp:
+        cov_ptrs += [np.intp(0)] * 3
+    block, grid = _launch_config(sorted_emittance_cov_per_slice_kernel,
+                                 sliceset.n_slices)
+    sorted_emittance_cov_per_slice_kernel(
+        sliceset.lower_bounds.gpudata, sliceset.upper_bounds.gpudata,
+        u.gpudata, up.gpudata, dp.gpudata if include_dp else np.intp(0),
+        np.int32(sliceset.n_slices), *cov_ptrs,
+        block=block, grid=grid, stream=stream)
+    cov_u2, cov_up2, cov_u_up = covs[:3]
     out = _empty_like(cov_u2)
     # use this factor in emitt_disp: the code has a 1/(n*n+n) factor which is not
     # required here since the scaling is done in the cov_per_slice
     # --> 1/(n*n + n) must be 1. ==> n = sqrt(5)/2 -0.5
     n = np.sqrt(5.)/2. - 0.5
 
-    include_dp = dp is not None
-    if include_dp:
-        cov_u_dp = sorted_cov_per_slice(sliceset, u, dp, stream=streams[3])
-        cov_up_dp= sorted_cov_per_slice(sliceset, up, dp, stream=streams[4])
-        cov_dp2 = sorted_cov_per_slice(sliceset, dp, dp, stream=streams[5])
-        for s in streams:
-            s.synchronize()
-        if not cov_dp2.get().any():
-            include_dp = False
-    else:
-        for s in streams[:3]:
-            s.synchronize()
-
+    # no host synchronisation: slices without momentum spread
+    # (cov_dp2 == 0) fall back to the effective emittance inside
+    # _emitt_disp, the result stays queued on stream
     if include_dp:
+        cov_u_dp, cov_up_dp, cov_dp2 = covs[3:]
         _emitt_disp(out, cov_u2, cov_u_up, cov_up2,
                     cov_u_dp, cov_up_dp, cov_dp2, np.float64(n), stream=stream)
     else:
@@ -793,21 +1013,77 @@ def sorted_emittance_per_slice(sliceset, u, up, dp=None, stream=None):
     return out
 
 
-def convolve(a, v, mode='full'):
-    '''
-    Compute the convolution of the two arrays a,v. See np.convolve
+# below this length the PCIe transfers to the host and back are cheaper
+# than the three FFTs of the padded arrays
+_convolve_fft_min_len = 32
+# cuFFT plans by FFT length, plan creation dominates for short signals
+_fft_plans = {}
+
+def _get_fft_plans(n_fft):
+    '''Return the (cached) forward real-to-complex and inverse
+    complex-to-real cuFFT plans for arrays of length n_fft.
     '''
-    #HACK: use np.convolve for now, make sure both arguments are np.arrays!
+    if n_fft not in _fft_plans:
+        _fft_plans[n_fft] = (
+            skcuda.fft.Plan(n_fft, np.float64, np.complex128),
+            skcuda.fft.Plan(n_fft, np.complex128, np.float64))
+    return _fft_plans[n_fft]
+
+def _convolve_host(a, v, mode):
+    '''np.convolve on the host, the result is transferred to the GPU.'''
     try:
         a = a.get()
-    except:
+    except AttributeError:
         pass
     try:
         v = v.get()
-    except:
+    except AttributeError:
         pass
     c = np.convolve(a, v, mode)
-    return pycuda.gpuarray.to_gpu(c)
+    return pycuda.gpuarray.to_gpu(c, allocator=gpu_utils.memory_pool.allocate)
+
+def convolve(a, v, mode='full'):
+    '''
+    Compute the convolution of the two arrays a,v. See np.convolve
+    The convolution is done on the GPU by multiplying the FFTs of the
+    zero-padded arrays. Short (or non float64) arrays are convolved
+    on the host via np.convolve.
+    '''
+    n_a, n_v = len(a), len(v)
+    if (min(n_a, n_v) < _convolve_fft_min_len or
+            a.dtype != np.float64 or v.dtype != np.float64):
+        return _convolve_host(a, v, mode)
+    if not isinstance(a, pycuda.gpuarray.GPUArray):
+        a = pycuda.gpuarray.to_gpu(a, allocator=gpu_utils.memory_pool.allocate)
+    if not isinstance(v, pycuda.gpuarray.GPUArray):
+        v = pycuda.gpuarray.to_gpu(v, allocator=gpu_utils.memory_pool.allocate)
+
+    n_full = n_a + n_v - 1
+    if mode == 'full':
+        start, length = 0, n_full
+    elif mode == 'same':
+        start, length = (min(n_a, n_v) - 1) // 2, max(n_a, n_v)
+    elif mode == 'valid':
+        start, length = min(n_a, n_v) - 1, max(n_a, n_v) - min(n_a, n_v) + 1
+    else:
+        raise ValueError("mode must be 'full', 'same' or 'valid'")
+
+    n_fft = 2**int(math.ceil(math.log(n_full, 2)))
+    plan_forward, plan_inverse = _get_fft_plans(n_fft)
+    a_padded = _zeros(n_fft, dtype=np.float64)
+    v_padded = _zeros(n_fft, dtype=np.float64)
+    drv.memcpy_dtod_async(a_padded.gpudata, a.gpudata, a.nbytes)
+    drv.memcpy_dtod_async(v_padded.gpudata, v.gpudata, v.nbytes)
+    a_fft = pycuda.gpuarray.empty(n_fft // 2 + 1, dtype=np.complex128,
+                                  allocator=gpu_utils.memory_pool.allocate)
+    v_fft = pycuda.gpuarray.empty(n_fft // 2 + 1, dtype=np.complex128,
+                                  allocator=gpu_utils.memory_pool.allocate)
+    skcuda.fft.fft(a_padded, a_fft, plan_forward)
+    skcuda.fft.fft(v_padded, v_fft, plan_forward)
+    _mul_complex(a_fft, v_fft)
+    # a_padded is not needed anymore, reuse it for the result
+    skcuda.fft.ifft(a_fft, a_padded, plan_inverse, True)
+    return a_padded[start:start + length]
 
 def init_bunch_buffer(bunch, bunch_stats, buffer_size):
     '''Call bunch.[stats], match the buffer type with the returned type'''
@@ -1,8 +1,12 @@
-__global__ void sorted_mean_per_slice(unsigned int* lower_bounds,
-                                      unsigned int* upper_bounds,
-                                      double* u,                    // array of particle quantity sorted by slice
-                                      unsigned int n_slices,
-                                      double* mean_u)               // output array of length n_slices with mean values for each slice
+// The per-slice kernels are launched with at most 256 threads per block
+// (cf. gpu_wrap._launch_config), __launch_bounds__ lets the compiler
+// limit the register usage such that 2 blocks fit on a multiprocessor.
+
+__global__ void __launch_bounds__(256, 2) sorted_mean_per_slice(unsigned int* lower_bounds,
+                                                                unsigned int* upper_bounds,
+                                                                double* u,                    // array of particle quantity sorted by slice
+                                                                unsigned int n_slices,
+                                                                double* mean_u)               // output array of length n_slices with mean values for each slice
 /**
     Iterate once through all the particles within the
     slicing region and calculate simultaneously the mean
@@ -37,11 +41,11 @@ __global__ void sorted_mean_per_slice(unsigned int* lower_bounds,
     }
 }
 
-__global__ void sorted_std_per_slice(unsigned int* lower_bounds,
-                                     unsigned int* upper_bounds,
-                                     double* u,                     // array of particle quantity sorted by slice
-                                     unsigned int n_slices,
-                                     double* cov_u)                 // output array of length n_slices with mean values for each slice
+__global__ void __launch_bounds__(256, 2) sorted_std_per_slice(unsigned int* lower_bounds,
+                                                               unsigned int* upper_bounds,
+                                                               double* u,                     // array of particle quantity sorted by slice
+                                                               unsigned int n_slices,
+                                                               double* cov_u)                 // output array of length n_slices with mean values for each slice
 /**
     Iterate once through all the particles within the
     slicing region and calculate simultaneously the
@@ -85,12 +89,59 @@ __global__ void sorted_std_per_slice(unsigned int* lower_bounds,
 }
 
 
-__global__ void sorted_cov_per_slice(unsigned int* lower_bounds,
-                                     unsigned int* upper_bounds,
-                                     double* u,                     // array of particle quantity sorted by slice
-                                     double* v,                     // 2nd array of particles
-                                     unsigned int n_slices,
-                                     double* cov_uv)                 // output array of length n_slices with mean values for each slice
+__global__ void __launch_bounds__(256, 2) sorted_mean_std_per_slice(unsigned int* lower_bounds,
+                                                                    unsigned int* upper_bounds,
+                                                                    double* u,                // array of particle quantity sorted by slice
+                                                                    unsigned int n_slices,
+                                                                    double* mean_u,           // output array of length n_slices with mean values for each slice
+                                                                    double* std_u)            // output array of length n_slices with std values for each slice
+/**
+    Iterate once through all the particles within the
+    slicing region and calculate simultaneously the mean
+    value and the standard deviation of quantity u for each
+    slice separately, using Welford's online algorithm. Reads
+    the particles once instead of twice as sorted_mean_per_slice
+    followed by sorted_std_per_slice.
+
+    Assumes the particle array u to be sorted by slices.
+
+    The index arrays lower_bounds and upper_bounds
+    indicate the start and end indices
+    within the sorted particle arrays for each slice. The respective
+    slice id is identical to the index within lower_bounds and
+    upper_bounds.
+*/
+{
+    for (int sid = blockIdx.x * blockDim.x + threadIdx.x;
+         sid < n_slices;
+         sid += blockDim.x * gridDim.x)
+    {
+        double l_mean = 0.;
+        double m2 = 0.;
+        unsigned int count = 0;
+        for (int pid = lower_bounds[sid]; pid < upper_bounds[sid]; pid++)
+        {
+            count++;
+            double delta = u[pid] - l_mean;
+            l_mean += delta / count;
+            m2 += delta * (u[pid] - l_mean);
+        }
+        mean_u[sid] = l_mean;
+        if (count <= 1) {
+            std_u[sid] = 0;
+        } else {
+            std_u[sid] = sqrt(m2 / (count - 1));
+        }
+    }
+}
+
+
+__global__ void __launch_bounds__(256, 2) sorted_cov_per_slice(unsigned int* lower_bounds,
+                                                               unsigned int* upper_bounds,
+                                                               double* u,                     // array of particle quantity sorted by slice
+                                                               double* v,                     // 2nd array of particles
+                                                               unsigned int n_slices,
+                                                               double* cov_uv)                 // output array of length n_slices with mean values for each slice
 /**
     Iterate once through all the particles within the
     slicing region and calculate simultaneously the
@@ -132,3 +183,234 @@ __global__ void sorted_cov_per_slice(unsigned int* lower_bounds,
         }
     }
 }
+
+
+__global__ void __launch_bounds__(256, 2) sorted_emittance_cov_per_slice(unsigned int* lower_bounds,
+                                                                         unsigned int* upper_bounds,
+                                                                         double* u,           // array of particle quantity sorted by slice
+                                                                         double* up,          // conjugate momentum of u
+                                                                         double* dp,          // momentum deviation, may be NULL
+                                                                         unsigned int n_slices,
+                                                                         double* cov_u2,      // output arrays of length n_slices
+                                                                         double* cov_up2,
+                                                                         double* cov_u_up,
+                                                                         double* cov_u_dp,    // dp outputs, NULL if dp is NULL
+                                                                         double* cov_up_dp,
+                                                                         double* cov_dp2)
+/**
+    Iterate through all the particles within the slicing region
+    and calculate simultaneously all covariances of the quantities
+    u, up and dp needed for the emittance of each slice. Each
+    particle quantity is loaded once per pass instead of once per
+    covariance as with sorted_cov_per_slice.
+
+    If dp is NULL, only cov_u2, cov_up2 and cov_u_up are computed
+    and the dp output arrays are not accessed.
+
+    Assumes the particle arrays to be sorted by slices.
+
+    The index arrays lower_bounds and upper_bounds
+    indicate the start and end indices
+    within the sorted particle arrays for each slice. The respective
+    slice id is identical to the index within lower_bounds and
+    upper_bounds.
+*/
+{
+    const bool include_dp = (dp != NULL);
+    for (int sid = blockIdx.x * blockDim.x + threadIdx.x;
+         sid < n_slices;
+         sid += blockDim.x * gridDim.x)
+    {
+        unsigned int n_macroparticles = upper_bounds[sid] - lower_bounds[sid];
+        if (n_macroparticles <= 1) {
+            cov_u2[sid] = 0;
+            cov_up2[sid] = 0;
+            cov_u_up[sid] = 0;
+            if (include_dp) {
+                cov_u_dp[sid] = 0;
+                cov_up_dp[sid] = 0;
+                cov_dp2[sid] = 0;
+            }
+            continue;
+        }
+        double sum_u = 0., sum_up = 0., sum_dp = 0.;
+        for (int pid = lower_bounds[sid]; pid < upper_bounds[sid]; pid++)
+        {
+            sum_u += u[pid];
+            sum_up += up[pid];
+            if (include_dp)
+                sum_dp += dp[pid];
+        }
+        double mean_u = sum_u / n_macroparticles;
+        double mean_up = sum_up / n_macroparticles;
+        double mean_dp = sum_dp / n_macroparticles;
+
+        double l_u2 = 0., l_up2 = 0., l_u_up = 0.;
+        double l_u_dp = 0., l_up_dp = 0., l_dp2 = 0.;
+        for (int pid = lower_bounds[sid]; pid < upper_bounds[sid]; pid++)
+        {
+            double du = u[pid] - mean_u;
+            double dup = up[pid] - mean_up;
+            l_u2 += du * du;
+            l_up2 += dup * dup;
+            l_u_up += du * dup;
+            if (include_dp) {
+                double ddp = dp[pid] - mean_dp;
+                l_u_dp += du * ddp;
+                l_up_dp += dup * ddp;
+                l_dp2 += ddp * ddp;
+            }
+        }
+        cov_u2[sid] = l_u2 / (n_macroparticles - 1);
+        cov_up2[sid] = l_up2 / (n_macroparticles - 1);
+        cov_u_up[sid] = l_u_up / (n_macroparticles - 1);
+        if (include_dp) {
+            cov_u_dp[sid] = l_u_dp / (n_macroparticles - 1);
+            cov_up_dp[sid] = l_up_dp / (n_macroparticles - 1);
+            cov_dp2[sid] = l_dp2 / (n_macroparticles - 1);
+        }
+    }
+}
+
+
+__global__ void slice_bounds_from_sorted(int* slice_index_of_particle,   // sorted slice ids, may lie outside [0, n_slices)
+                                         unsigned int n_particles,       // must be at least 1
+                                         unsigned int n_slices,
+                                         unsigned int* lower_bounds,     // output arrays of length n_slices
+                                         unsigned int* upper_bounds)
+/**
+    Compute the start (lower_bounds) and end (upper_bounds) index
+    of each slice within the sorted particle arrays in one pass,
+    equivalent to a lower_bound and an upper_bound binary search
+    for every slice id.
+
+    Thread pid looks at the transition between particles pid-1
+    and pid (with virtual particles before the first and after the
+    last one). Where the slice id changes, the transition position
+    pid is the lower bound of all slices in (previous, next] and the
+    upper bound of all slices in [previous, next), clipped to the
+    valid slice ids. Empty slices are covered by these ranges as
+    well, hence every bound is written exactly once and the outputs
+    do not need to be initialised.
+*/
+{
+    for (int pid = blockIdx.x * blockDim.x + threadIdx.x;
+         pid <= n_particles;
+         pid += blockDim.x * gridDim.x)
+    {
+        int prev, next;
+        if (pid > 0) {
+            prev = slice_index_of_particle[pid - 1];
+        } else {
+            prev = min(slice_index_of_particle[0], 0) - 1;
+        }
+        if (pid < n_particles) {
+            next = slice_index_of_particle[pid];
+        } else {
+            next = max(slice_index_of_particle[n_particles - 1],
+                       (int)n_slices - 1) + 1;
+        }
+        if (prev == next)
+            continue;
+        int last = min(next, (int)n_slices - 1);
+        for (int sid = max(prev + 1, 0); sid <= last; sid++)
+            lower_bounds[sid] = pid;
+        last = min(next - 1, (int)n_slices - 1);
+        for (int sid = max(prev, 0); sid <= last; sid++)
+            upper_bounds[sid] = pid;
+    }
+}
+
+
+__global__ void covariance_sums(double* a,
+                                double* b,
+                                unsigned int n,
+                                double* partial_sums)       // output array of length 3 * gridDim.x
+/**
+    Iterate once through the arrays a and b and accumulate
+    sum(a - a[0]), sum(b - b[0]) and sum((a - a[0]) * (b - b[0]))
+    for each block. Shifting by the first entry keeps the single
+    pass covariance formula from cancelling catastrophically when
+    the mean is large compared to the spread.
+
+    Requires blockDim.x to be a power of 2 and
+    3 * blockDim.x doubles of dynamic shared memory.
+    The block results are stored in partial_sums[3 * blockIdx.x + k]
+    and combined by covariance_sums_finalize.
+*/
+{
+    extern __shared__ double sdata[];
+    double a0 = 0., b0 = 0.;
+    if (n > 0) {
+        a0 = a[0];
+        b0 = b[0];
+    }
+    double sum_a = 0., sum_b = 0., sum_ab = 0.;
+    for (int pid = blockIdx.x * blockDim.x + threadIdx.x;
+         pid < n;
+         pid += blockDim.x * gridDim.x)
+    {
+        double da = a[pid] - a0;
+        double db = b[pid] - b0;
+        sum_a += da;
+        sum_b += db;
+        sum_ab += da * db;
+    }
+    unsigned int tid = threadIdx.x;
+    sdata[tid] = sum_a;
+    sdata[tid + blockDim.x] = sum_b;
+    sdata[tid + 2 * blockDim.x] = sum_ab;
+    __syncthreads();
+    for (unsigned int s = blockDim.x / 2; s > 0; s >>= 1) {
+        if (tid < s) {
+            sdata[tid] += sdata[tid + s];
+            sdata[tid + blockDim.x] += sdata[tid + blockDim.x + s];
+            sdata[tid + 2 * blockDim.x] += sdata[tid + 2 * blockDim.x + s];
+        }
+        __syncthreads();
+    }
+    if (tid == 0) {
+        partial_sums[3 * blockIdx.x] = sdata[0];
+        partial_sums[3 * blockIdx.x + 1] = sdata[blockDim.x];
+        partial_sums[3 * blockIdx.x + 2] = sdata[2 * blockDim.x];
+    }
+}
+
+__global__ void covariance_sums_finalize(double* partial_sums,
+                                         unsigned int n_partial,
+                                         double n,
+                                         double* centered_sum)  // output array of length 1
+/**
+    Combine the n_partial block results of covariance_sums and
+    store sum((a - mean_a) * (b - mean_b)) in centered_sum[0].
+    The shift by the first entry cancels in the result.
+
+    To be launched with a single block, blockDim.x a power of 2 and
+    3 * blockDim.x doubles of dynamic shared memory.
+*/
+{
+    extern __shared__ double sdata[];
+    double sum_a = 0., sum_b = 0., sum_ab = 0.;
+    for (int bid = threadIdx.x; bid < n_partial; bid += blockDim.x)
+    {
+        sum_a += partial_sums[3 * bid];
+        sum_b += partial_sums[3 * bid + 1];
+        sum_ab += partial_sums[3 * bid + 2];
+    }
+    unsigned int tid = threadIdx.x;
+    sdata[tid] = sum_a;
+    sdata[tid + blockDim.x] = sum_b;
+    sdata[tid + 2 * blockDim.x] = sum_ab;
+    __syncthreads();
+    for (unsigned int s = blockDim.x / 2; s > 0; s >>= 1) {
+        if (tid < s) {
+            sdata[tid] += sdata[tid + s];
+            sdata[tid + blockDim.x] += sdata[tid + blockDim.x + s];
+            sdata[tid + 2 * blockDim.x] += sdata[tid + 2 * blockDim.x + s];
+        }
+        __syncthreads();
+    }
+    if (tid == 0) {
+        centered_sum[0] = sdata[2 * blockDim.x] - sdata[0] * sdata[blockDim.x] / n;
+    }
+}
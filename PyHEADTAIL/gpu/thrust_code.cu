@@ -10,6 +10,7 @@
 #include <thrust/transform.h>
 #include <thrust/reduce.h>
 #include <thrust/functional.h>
+#include <cub/device/device_radix_sort.cuh>
 #include <cmath>
 #include "math.h"
 
@@ -44,6 +45,36 @@ void thrust_get_sort_perm_int(int* input_ptr, int length, int* perm_ptr)
   thrust::sort_by_key(thrust_ptr, thrust_ptr + length, indices);
 }
 
+// ---------------- sorting using CUB ---------------- //
+
+// Radix sort the keys input_ptr and store the sorting permutation in
+// perm_ptr, seq_ptr must hold the sequence 0, 1, ..., length-1.
+// Unlike thrust::sort_by_key the input is left untouched, the sorted keys
+// are written to keys_out_ptr. The scratch buffer temp_ptr is provided by
+// the caller (so it can be reused), if it is NULL only its required size
+// is written to temp_bytes and nothing is sorted.
+// Only the bits [0, end_bit) of the keys are compared.
+
+void cub_get_sort_perm_double(double* input_ptr, int length,
+                              double* keys_out_ptr, int* seq_ptr,
+                              int* perm_ptr, void* temp_ptr,
+                              size_t* temp_bytes, int end_bit)
+{
+  cub::DeviceRadixSort::SortPairs(temp_ptr, *temp_bytes,
+                                  input_ptr, keys_out_ptr, seq_ptr, perm_ptr,
+                                  length, 0, end_bit);
+}
+
+void cub_get_sort_perm_int(int* input_ptr, int length,
+                           int* keys_out_ptr, int* seq_ptr,
+                           int* perm_ptr, void* temp_ptr,
+                           size_t* temp_bytes, int end_bit)
+{
+  cub::DeviceRadixSort::SortPairs(temp_ptr, *temp_bytes,
+                                  input_ptr, keys_out_ptr, seq_ptr, perm_ptr,
+                                  length, 0, end_bit);
+}
+
 void thrust_apply_sort_perm_double(double* input_ptr, int length, double* output_ptr, int* perm_ptr)
 {
   thrust::device_ptr<double> thrust_input_ptr(input_ptr);
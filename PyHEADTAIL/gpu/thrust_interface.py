@@ -155,6 +155,84 @@ def get_sort_perm_int(input, out):
                                             int(out.gpudata))
 
 
+#### cub_get_sort_perm_double / cub_get_sort_perm_int ##########################
+#void cub_get_sort_perm_double(double* input_ptr, int length,
+#                              double* keys_out_ptr, int* seq_ptr,
+#                              int* perm_ptr, void* temp_ptr,
+#                              size_t* temp_bytes, int end_bit)
+_cub_sort_perm_argtypes = [
+    ctypes.c_void_p, #input_ptr
+    ctypes.c_int,    #length
+    ctypes.c_void_p, #keys_out_ptr
+    ctypes.c_void_p, #seq_ptr
+    ctypes.c_void_p, #perm_ptr
+    ctypes.c_void_p, #temp_ptr
+    ctypes.c_void_p, #temp_bytes
+    ctypes.c_int,    #end_bit
+]
+_libthrustwrap.cub_get_sort_perm_double.restype = None
+_libthrustwrap.cub_get_sort_perm_double.argtypes = _cub_sort_perm_argtypes
+_libthrustwrap.cub_get_sort_perm_int.restype = None
+_libthrustwrap.cub_get_sort_perm_int.argtypes = _cub_sort_perm_argtypes
+
+def _cub_sort_perm_temp_bytes(cub_func, length, end_bit):
+    temp_bytes = np.zeros((), dtype=np.uintp)
+    cub_func(None, np.int32(length), None, None, None, None,
+             int(temp_bytes.ctypes.data), np.int32(end_bit))
+    return int(temp_bytes)
+
+def _cub_get_sort_perm(cub_func, input, out, seq, keys_out,
+                       temp, temp_bytes, end_bit):
+    temp_bytes = np.array(temp_bytes, dtype=np.uintp)
+    cub_func(int(input.gpudata), np.int32(len(input)), int(keys_out.gpudata),
+             int(seq.gpudata), int(out.gpudata), int(temp),
+             int(temp_bytes.ctypes.data), np.int32(end_bit))
+
+def sort_perm_temp_bytes_double(length, end_bit=64):
+    '''
+    Return the size in bytes of the scratch buffer which
+    get_sort_perm_double_cub requires to sort length keys
+    '''
+    return _cub_sort_perm_temp_bytes(
+        _libthrustwrap.cub_get_sort_perm_double, length, end_bit)
+
+def get_sort_perm_double_cub(input, out, seq, keys_out, temp, temp_bytes,
+                             end_bit=64):
+    '''
+    Radix sort the GPUArray (double) input with CUB and store the used
+    permutation in out (int). input is left untouched, the sorted keys
+    are stored in keys_out (double).
+    Args:
+        seq: GPUArray (int) holding 0, 1, ..., len(input)-1
+        temp, temp_bytes: device scratch buffer and its size, it must be
+            at least sort_perm_temp_bytes_double(len(input), end_bit)
+        end_bit: only the bits [0, end_bit) of the keys are sorted
+    '''
+    _cub_get_sort_perm(_libthrustwrap.cub_get_sort_perm_double, input, out,
+                       seq, keys_out, temp, temp_bytes, end_bit)
+
+def sort_perm_temp_bytes_int(length, end_bit=32):
+    '''
+    Return the size in bytes of the scratch buffer which
+    get_sort_perm_int_cub requires to sort length keys
+    '''
+    return _cub_sort_perm_temp_bytes(
+        _libthrustwrap.cub_get_sort_perm_int, length, end_bit)
+
+def get_sort_perm_int_cub(input, out, seq, keys_out, temp, temp_bytes,
+                          end_bit=32):
+    '''
+    Radix sort the GPUArray (int) input with CUB and store the used
+    permutation in out (int). input is left untouched, the sorted keys
+    are stored in keys_out (int). For keys known to lie in
+    [0, 2**end_bit), a smaller end_bit saves radix passes. Negative keys
+    require the full width.
+    Args: cf. get_sort_perm_double_cub
+    '''
+    _cub_get_sort_perm(_libthrustwrap.cub_get_sort_perm_int, input, out,
+                       seq, keys_out, temp, temp_bytes, end_bit)
+
+
 #### thrust_cumsum_double ###############################################
 #void thrust_cumsum_double(double* data_ptr, int length, double* sum_ptr)
 _libthrustwrap.thrust_cumsum_double.restype = None
@@ -144,6 +144,32 @@ class TestDispatch(unittest.TestCase):
         res_gpu = pm._GPU_func_dict[fname](*params_gpu)
         self.assertTrue(np.allclose(res_cpu, res_gpu.get()),
             'CPU/GPU version of ' + fname + ' dont yield the same result')
+        out_gpu = pycuda.gpuarray.empty_like(parameter_gpu_tosort)
+        res_gpu = pm._GPU_func_dict[fname](*params_gpu, out=out_gpu)
+        self.assertTrue(res_gpu is out_gpu and
+                        np.allclose(res_cpu, out_gpu.get()),
+            'GPU version of ' + fname + ' ignores the out argument')
+
+    @unittest.skipUnless(has_pycuda, 'pycuda not found')
+    def test_argsort(self):
+        '''
+        Check that the GPU argsort is a stable sort for float64 and int32
+        (including negative slice indices) and leaves its input untouched
+        '''
+        fname = 'argsort'
+        np.random.seed(0)
+        n = 9999
+        to_sort_cpu = [np.random.normal(size=n),
+                       np.array(np.random.randint(-3, 20, size=n),
+                                dtype=np.int32)]
+        for arr_cpu in to_sort_cpu:
+            arr_gpu = pycuda.gpuarray.to_gpu(arr_cpu)
+            res_cpu = np.argsort(arr_cpu, kind='mergesort')
+            res_gpu = pm._GPU_func_dict[fname](arr_gpu)
+            self.assertTrue(np.array_equal(res_cpu, res_gpu.get()),
+                'CPU/GPU version of ' + fname + ' dont yield the same result')
+            self.assertTrue(np.array_equal(arr_cpu, arr_gpu.get()),
+                'GPU ' + fname + ' modifies its input')
 
     @unittest.skipUnless(has_pycuda, 'pycuda not found')
     def test_per_slice_stats(self):
@@ -171,6 +197,13 @@ class TestDispatch(unittest.TestCase):
             res_gpu = pm._GPU_func_dict[fname](sliceset_gpu,z_gpu)
             self.assertTrue(np.allclose(res_cpu, res_gpu.get()),
                 'CPU/GPU version of ' + fname + ' dont yield the same result')
+        mean_gpu, std_gpu = pm.gpu_wrap.sorted_mean_std_per_slice(
+            sliceset_gpu, z_gpu)
+        for fname, res_gpu in zip(fnames, [mean_gpu, std_gpu]):
+            res_cpu = pm._CPU_numpy_func_dict[fname](sliceset_cpu, z_cpu)
+            self.assertTrue(np.allclose(res_cpu, res_gpu.get()),
+                'sorted_mean_std_per_slice and CPU version of ' + fname +
+                ' dont yield the same result')
         fnames = ['emittance_per_slice']
         v_cpu = b.x
         v_gpu = pycuda.gpuarray.to_gpu(v_cpu)
@@ -216,6 +249,14 @@ class TestDispatch(unittest.TestCase):
             res_gpu = pm._GPU_func_dict[f](*params_gpu)
             self.assertTrue(np.allclose(res_cpu, res_gpu.get()),
                 'CPU/GPU version of ' + f + ' dont yield the same result')
+        # re-slicing must not reuse the bounds of the old slice indices
+        sliceset_gpu.slice_index_of_particle = pycuda.gpuarray.zeros(
+            n, dtype=np.int32)
+        expected = np.zeros(sliceset_gpu.n_slices, dtype=np.int32)
+        expected[0] = n
+        res_gpu = pm._GPU_func_dict['macroparticles_per_slice'](sliceset_gpu)
+        self.assertTrue(np.array_equal(expected, res_gpu.get()),
+            'GPU bounds are not recomputed after re-slicing')
 
     @unittest.skipUnless(has_pycuda, 'pycuda not found')
     def test_take(self):